@@ -0,0 +1,14 @@
+"""Progress bar shared by the utils modules."""
+
+# Import tqdm_notebook if in Jupyter notebook
+try:
+    from IPython import get_ipython
+
+    if "IPKernelApp" not in get_ipython().config:
+        raise ImportError("console")
+except (AttributeError, ImportError):
+    from tqdm import tqdm
+else:
+    from tqdm import tqdm_notebook as tqdm
+
+__all__ = ["tqdm"]
@@ -1,22 +1,52 @@
 """Classes for constructing image-agnostic features."""
 
-import numpy as np
+import inspect
+import warnings
 from types import SimpleNamespace
 
-# Import tqdm_notebook if in Jupyter notebook
+import numpy as np
+
+from utils._tqdm import tqdm
+
+# Use numba to compile the spatial feature kernel if it is installed
 try:
-    from IPython import get_ipython
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
-    if "IPKernelApp" not in get_ipython().config:
-        raise ImportError("console")
-except (AttributeError, ImportError):
-    from tqdm import tqdm
-else:
-    from tqdm import tqdm
+
+def build_categorical_matrix(sub_ids, obj_ids, num_categories, packed=False):
+    """Builds the one-hot categorical features for a batch of relationships.
+
+    Args:
+        sub_ids: [N] array of subject category indexes.
+        obj_ids: [N] array of object category indexes.
+        num_categories: Number of possible categories.
+        packed: Whether to bit-pack each row with `np.packbits`, for an 8x
+            smaller matrix. Consumers must `np.unpackbits(..., axis=1,
+            count=2 * num_categories)` before use.
+
+    Returns:
+        [N, 2 * num_categories] uint8 matrix with the subject one-hot in the
+        first `num_categories` columns and the object one-hot in the rest, or
+        its [N, ceil(2 * num_categories / 8)] packed form.
+    """
+    sub_ids = np.asarray(sub_ids, dtype=np.intp)
+    obj_ids = np.asarray(obj_ids, dtype=np.intp)
+    rows = np.arange(len(sub_ids))
+    M = np.zeros((len(sub_ids), 2 * num_categories), dtype=np.uint8)
+    M[rows, sub_ids] = 1
+    M[rows, num_categories + obj_ids] = 1
+    if packed:
+        return np.packbits(M, axis=1)
+    return M
 
 
 class CategoricalPrim(object):
     """Simple one-hit category wrapper.
+
+    Kept for single-relationship use; batches should go through
+    `build_categorical_matrix`.
     """
 
     def __init__(self, subject_index, object_index, num_categories=100):
@@ -36,11 +66,10 @@ class CategoricalPrim(object):
         Returns:
             A list of features.
         """
-        subs = [0] * self.num_categories
-        subs[self.subject_index] = 1
-        objs = [0] * self.num_categories
-        objs[self.object_index] = 1
-        return subs + objs
+        M = build_categorical_matrix(
+            [self.subject_index], [self.object_index], self.num_categories
+        )
+        return M[0].tolist()
 
     def __eq__(self, other):
         """Checks if two categories are the same.
@@ -134,7 +163,7 @@ class BBoxPrim(object):
     def __hash__(self):
         """Hash of object.
         """
-        return hash(str(self.get_bbox()))
+        return hash((self.y0, self.y1, self.x0, self.x1))
 
 
 class SpatialPrim(object):
@@ -199,10 +228,92 @@ class SpatialPrim(object):
     def __hash__(self):
         """Hash of object.
         """
-        return hash(str(self.subject_bbox.hash()) + "-" + str(self.object_bbox.hash()))
+        return hash((self.subject_bbox, self.object_bbox))
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _spatial_kernel(sub, obj, out):
+        """Writes the spatial features of each (sub, obj) box pair into `out`."""
+        for i in prange(sub.shape[0]):
+            w_s = sub[i, 2] - sub[i, 0]
+            h_s = sub[i, 3] - sub[i, 1]
+            w_o = obj[i, 2] - obj[i, 0]
+            h_o = obj[i, 3] - obj[i, 1]
+            out[i, 0] = (sub[i, 0] - obj[i, 0]) / w_s
+            out[i, 1] = (sub[i, 2] - obj[i, 2]) / w_s
+            out[i, 2] = (sub[i, 1] - obj[i, 1]) / h_s
+            out[i, 3] = (sub[i, 3] - obj[i, 3]) / h_s
+            out[i, 4] = w_o / w_s
+            out[i, 5] = h_o / h_s
+            out[i, 6] = (w_o * h_o) / (w_s * h_s)
+
+
+else:
+    _spatial_kernel = None
+
+
+def spatial_features_batch(sub_boxes, obj_boxes):
+    """Computes the `SpatialPrim` features for a batch of relationships.
+
+    Args:
+        sub_boxes: [N, 4] array of subject boxes as (x0, y0, x1, y1).
+        obj_boxes: [N, 4] array of object boxes as (x0, y0, x1, y1).
+
+    Returns:
+        [N, 7] array of features, ordered as in `SpatialPrim.extract_features`.
+        Uses a compiled, multi-threaded kernel when numba is installed.
+
+    Raises:
+        ValueError: If a subject box has zero width or height.
+    """
+    sub = np.ascontiguousarray(sub_boxes, dtype=np.float64)
+    obj = np.ascontiguousarray(obj_boxes, dtype=np.float64)
+    empty = (sub[:, 2] == sub[:, 0]) | (sub[:, 3] == sub[:, 1])
+    if empty.any():
+        raise ValueError(
+            "Subject box %s has zero width or height." % sub[np.argmax(empty)]
+        )
+    if _spatial_kernel is not None:
+        out = np.empty((sub.shape[0], 7), dtype=np.float64)
+        _spatial_kernel(sub, obj, out)
+        return out
+
+    w_s = sub[:, 2] - sub[:, 0]
+    h_s = sub[:, 3] - sub[:, 1]
+    w_o = obj[:, 2] - obj[:, 0]
+    h_o = obj[:, 3] - obj[:, 1]
+    return np.stack(
+        [
+            (sub[:, 0] - obj[:, 0]) / w_s,
+            (sub[:, 2] - obj[:, 2]) / w_s,
+            (sub[:, 1] - obj[:, 1]) / h_s,
+            (sub[:, 3] - obj[:, 3]) / h_s,
+            w_o / w_s,
+            h_o / h_s,
+            (w_o * h_o) / (w_s * h_s),
+        ],
+        axis=1,
+    )
+
+
+def _vg_obj_box(obj):
+    """Returns the (x0, y0, x1, y1) box of a VG object with 'x', 'y', 'w', 'h'."""
+    return (obj["x"], obj["y"], obj["x"] + obj["w"], obj["y"] + obj["h"])
 
 
 def find_name_in_syns(name, syns):
+    """Finds the key in `syns` whose synonyms contain `name`.
+
+    Deprecated: scans every entry of `syns`. For repeated lookups, invert
+    `syns` once into a synonym -> key dict instead.
+    """
+    warnings.warn(
+        "find_name_in_syns is deprecated; invert the synonyms dict instead.",
+        DeprecationWarning,
+        stacklevel=2,
+    )
     for k, v in syns.items():
         if name in v:
             return k
@@ -225,41 +336,59 @@ def get_primitive_features(relationships, entity_list, object_synonyms):
         List of examples with .spatial and .categorical feature attributes
     """
 
-    examples = []
+    num_categories = len(entity_list)
+    name_to_idx = {name: i for i, name in enumerate(entity_list)}
+    # first match wins, as in `find_name_in_syns`
+    syn_to_key = {}
+    for k, syns in object_synonyms.items():
+        for syn in syns:
+            syn_to_key.setdefault(syn, k)
+
+    def resolve_idx(name):
+        """Index of `name`, or of the common name it is a synonym of."""
+        if name not in name_to_idx:
+            key = syn_to_key.get(name)
+            if key is None:
+                raise ValueError("%s not found in syns" % name)
+            name = key
+        return name_to_idx[name]
+
+    sub_boxes = []
+    obj_boxes = []
+    sub_ids = []
+    obj_ids = []
     for a in tqdm(relationships):
         for r in a["relationships"]:
-            # create features
-            sub = BBoxPrim.from_vg_obj(r["subject"])
-            obj = BBoxPrim.from_vg_obj(r["object"])
-            rel = SpatialPrim(sub, obj)
-            spatial_features = rel.extract_features()
+            sub_boxes.append(_vg_obj_box(r["subject"]))
+            obj_boxes.append(_vg_obj_box(r["object"]))
 
             # get object name, or find the common name from list of synonyms
-            sub_name = get_vg_obj_name(r["subject"])
-            if sub_name not in entity_list:
-                sub_name = find_name_in_syns(sub_name, object_synonyms)
-            obj_name = get_vg_obj_name(r["object"])
-            if obj_name not in entity_list:
-                obj_name = find_name_in_syns(obj_name, object_synonyms)
-
-            sub_id = entity_list.index(sub_name)
-            obj_id = entity_list.index(obj_name)
-            cat = CategoricalPrim(sub_id, obj_id, num_categories=len(entity_list))
-            categorical_features = cat.extract_features()
-
-            x = SimpleNamespace(
-                spatial=np.array(spatial_features), 
-                categorical=np.array(categorical_features)
-            )
-            examples.append(x)
+            sub_ids.append(resolve_idx(get_vg_obj_name(r["subject"])))
+            obj_ids.append(resolve_idx(get_vg_obj_name(r["object"])))
+
+    # Staged as float64, the dtype `spatial_features_batch` computes in, so
+    # the boxes are not copied again there
+    spatial_features = spatial_features_batch(
+        np.array(sub_boxes, dtype=np.float64).reshape(-1, 4),
+        np.array(obj_boxes, dtype=np.float64).reshape(-1, 4),
+    )
+    categorical_features = build_categorical_matrix(
+        sub_ids, obj_ids, num_categories=num_categories
+    )
 
+    examples = [
+        SimpleNamespace(spatial=spatial, categorical=categorical)
+        for spatial, categorical in zip(spatial_features, categorical_features)
+    ]
     return examples
 
 
-def get_deep_features(relationships):
+def get_deep_features(relationships, batch_size=64, num_workers=8):
     """ Generates matrix of deep features given relationships.
     Args:
         annotations: list of relationships from VG (e.g. relationships.json)
+        batch_size: number of box pairs per forward pass
+        num_workers: number of loader processes preparing batches ahead of the GPU
     Returns: deep features (N x 2048)
     """
 
@@ -275,8 +404,23 @@ def get_deep_features(relationships):
             data.append((fn, sub, obj))
 
     dataset = BBoxDataset(data, image_dir="data/VisualGenome/VG_100K", image_size=224)
+    # Workers stay alive and prefetch into pinned memory, so that image
+    # decoding and cropping overlap with inference. `persistent_workers` and
+    # `prefetch_factor` only exist from torch 1.7, so pass them when supported.
+    worker_kwargs = {}
+    if num_workers > 0:
+        loader_params = inspect.signature(DataLoader).parameters
+        if "persistent_workers" in loader_params:
+            worker_kwargs["persistent_workers"] = True
+        if "prefetch_factor" in loader_params:
+            worker_kwargs["prefetch_factor"] = 4
     data_loader = DataLoader(
-        dataset=dataset, batch_size=8, shuffle=False, num_workers=4
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=True,
+        **worker_kwargs,
     )
-    features = extract_resnet_features(data_loader, batch_size=8)
+    features = extract_resnet_features(data_loader, batch_size=batch_size)
     return features
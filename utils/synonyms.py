@@ -1,6 +1,3 @@
-import copy
-
-
 class SimilarCategories(object):
     """This class helps find similar categories.
     """
@@ -30,17 +27,15 @@ class SimilarCategories(object):
                 each line containing a comma (,) separated list of categories.
 
         Returns:
-            A dictionary from the words to its categories.
+            A dictionary from the words to the set of its categories.
         """
         alias_map = {}
-        f = open(alias_file, "r")
-        for line in f:
-            cats = line.strip().split(",")
-            for cat in cats:
-                for word in cat.split(" "):
-                    if word not in alias_map:
-                        alias_map[word] = []
-                    alias_map[word].extend(cats)
+        with open(alias_file, "r") as f:
+            for line in f:
+                cats = line.strip().split(",")
+                for cat in cats:
+                    for word in cat.split(" "):
+                        alias_map.setdefault(word, set()).update(cats)
         return alias_map
 
     def _get_similar_categories(self, seed_list, alias_map):
@@ -48,20 +43,20 @@ class SimilarCategories(object):
 
         Args:
             seed_list: A list of initial categories.
-            alias_map: A dictionary from a category to its categories.
+            alias_map: A dictionary from a word to the set of its categories.
 
         Returns:
             A complete list of categories.
         """
-        prev_set = set(seed_list)
-        curr_set = set([])
-        while prev_set != curr_set:
-            for cat in prev_set:
-                for word in cat.split(" "):
-                    if word in alias_map:
-                        curr_set.update(alias_map[word])
-            prev_set = copy.deepcopy(curr_set)
-        return list(curr_set)
+        # Aliases are expanded one hop from the seeds. Following them
+        # transitively would chain categories together through shared words.
+        similar = {
+            alias
+            for cat in seed_list
+            for word in cat.split(" ")
+            for alias in alias_map.get(word, ())
+        }
+        return list(similar)
 
     def get_similar_objects(self, seed_list):
         """Gets the aliases of the object in the seed list.
@@ -1,23 +1,12 @@
 """Contains code to generate the individual datasets for all the predicates.
 """
 
-import copy
-import random
 import warnings
 from collections import defaultdict
 
 import numpy as np
 
-# Import tqdm_notebook if in Jupyter notebook
-try:
-    from IPython import get_ipython
-
-    if "IPKernelApp" not in get_ipython().config:
-        raise ImportError("console")
-except (AttributeError, ImportError):
-    from tqdm import tqdm_notebook as tqdm
-else:
-    from tqdm import tqdm
+from utils._tqdm import tqdm
 
 
 def get_vg_obj_name(obj):
@@ -36,45 +25,120 @@ def get_vg_obj_name(obj):
     return name
 
 
-def filter_relationships(annotations, condition, inplace=False):
+def normalize_predicates(annotations):
+    """Lowercases every predicate in place, except the `UNLABELED` marker.
+
+    Call once after loading; the rest of this module expects lowercase
+    predicates (apart from the `UNLABELED` marker).
+
+    Args:
+        annotations: list of relationships from VG (e.g. relationships.json)
+    """
+    for a in annotations:
+        for r in a["relationships"]:
+            if r["predicate"] != "UNLABELED":
+                r["predicate"] = r["predicate"].lower()
+
+
+def _check_normalized(pred):
+    """Raises a ValueError if `pred` was not lowercased by `normalize_predicates`.
+
+    Args:
+        pred: predicate that failed a lookup
+    """
+    if pred != "UNLABELED" and pred != pred.lower():
+        raise ValueError(
+            f"Predicate {pred!r} is not lowercase; run normalize_predicates on "
+            "the annotations after loading them."
+        )
+
+
+def _valid_relationships(rels):
+    """Yields relationships with valid bounding boxes.
+
+    Args:
+        rels: list of relationships for a single image
+    Returns: generator over the relationships whose boxes are non-empty
+    """
+
+    def invalid_bbox(obj):
+        """Determine whether a bounding box construction is invalid."""
+        return obj["h"] == 0 or obj["w"] == 0
+
+    for r in rels:
+        if invalid_bbox(r["subject"]):
+            msg = f"Invalid bbox: {r['subject']}. Skipping rel."
+            warnings.warn(msg)
+            continue
+        elif invalid_bbox(r["object"]):
+            msg = f"Invalid bbox: {r['object']}. Skipping rel."
+            warnings.warn(msg)
+            continue
+
+        yield r
+
+
+def filter_relationships(annotations, condition, inplace=True):
     """Filters list of relationships for the predicates specified.
 
+    Predicates are passed to `condition` as stored; run `normalize_predicates`
+    first so that they are lowercase.
+
     Args:
         annotations: list of relationships from VG (e.g. relationships.json)
         condition: function operating over each rel `r` specifying when to keep a relationship
-        inplace: whether to modify a set of annotations inplace.
+        inplace: whether to modify a set of annotations inplace. Pass False to
+            leave `annotations` untouched; only the annotation dicts are copied,
+            relationship dicts are shared with the input.
     Returns:
         filtered_annotations: list of relationships containing only those
-            associated with predicate_synonyms
+            associated with predicate_synonyms (None if inplace)
     """
 
-    def invalid_bbox(obj):
-        """Determine whether a bounding box construction is invalid."""
-        return obj["h"] == 0 or obj["w"] == 0
+    if inplace:
+        filtered_annotations = annotations
+    else:
+        filtered_annotations = [dict(a) for a in annotations]
+
+    for a in tqdm(filtered_annotations):
+        a["relationships"] = [
+            r for r in _valid_relationships(a["relationships"]) if condition(r)
+        ]
+
+    if not inplace:
+        return filtered_annotations
+
+
+def filter_relationships_by_predicate(annotations, predicate_set, inplace=True):
+    """Filters list of relationships down to the predicates in `predicate_set`.
+
+    Equivalent to `filter_relationships` with a predicate membership condition,
+    without calling a condition function per relationship. Predicates are
+    matched as stored, so run `normalize_predicates` first; otherwise
+    mixed-case predicates are dropped.
+
+    Args:
+        annotations: list of relationships from VG (e.g. relationships.json)
+        predicate_set: collection of lowercase predicates to keep
+        inplace: whether to modify a set of annotations inplace (see
+            `filter_relationships`).
+    Returns:
+        filtered_annotations: list of relationships containing only those
+            with a predicate in `predicate_set` (None if inplace)
+    """
+    predicate_set = set(predicate_set)
 
     if inplace:
         filtered_annotations = annotations
     else:
-        filtered_annotations = copy.deepcopy(annotations)
+        filtered_annotations = [dict(a) for a in annotations]
 
     for a in tqdm(filtered_annotations):
-        rels = a["relationships"]
-        selected_rels = []
-        for idx, r in enumerate(rels):
-            if invalid_bbox(r["subject"]):
-                msg = f"Invalid bbox: {r['subject']}. Skipping rel."
-                warnings.warn(msg)
-                continue
-            elif invalid_bbox(r["object"]):
-                msg = f"Invalid bbox: {r['object']}. Skipping rel."
-                warnings.warn(msg)
-                continue
-
-            r["predicate"] = r["predicate"].lower()
-            if condition(r):
-                selected_rels.append(r)
-
-        a["relationships"] = selected_rels
+        a["relationships"] = [
+            r
+            for r in _valid_relationships(a["relationships"])
+            if r["predicate"] in predicate_set
+        ]
 
     if not inplace:
         return filtered_annotations
@@ -106,49 +170,61 @@ def count_relationships(annotations, syns_to_preds=None):
 
 def sample_relationships(relationships, pred_counts, n_per_pred):
     """Randomly samples up to `n_per_pred` relationships per predicate.
-    
+
+    Sampling draws from `np.random`, so seed it for reproducible samples.
+
     Args:
         relationships: list of relationships from VG (e.g. relationships.json)
         pred_counts: dict of predicate names to corresponding counts in relationships
         n_per_pred: number of labels to keep per predicate
     Returns:
         sample_train: copy of relationships with `UNLABELED` in place of relationships
-            with removed labels
+            with removed labels. Only the relabeled relationship dicts are copied;
+            the others, and all subject/object dicts, are shared with `relationships`.
     """
 
-    # Store per-predicate indexes for relationships that we should keep
-    pred_idx_samples = {}
-
-    # First, sample for the lowest-label relationships
-    sorted_counts = sorted(pred_counts.items(), key=lambda kv: kv[1])
-    for pred, pred_count in sorted_counts:
-        pred = pred.lower()
-        # Randomly sample up to `n_per_red` relationships
-        if pred_count < n_per_pred:
-            # Sample all `pred_count` relationships
-            pred_idx_samples[pred] = list(range(pred_count))
-        else:
-            pred_idx_samples[pred] = random.sample(list(range(pred_count)), n_per_pred)
-
-    # Keep track of the idx for each relationship
-    rel_idx = {pred: -1 for pred in pred_counts.keys()}
-    sampled_train = copy.deepcopy(relationships)
-
-    for a in sampled_train:
+    # Predicate id of every relationship, in traversal order
+    pred_to_id = {pred: i for i, pred in enumerate(pred_counts)}
+
+    def pred_id(pred):
+        """Id of `pred`, with a clear error for unnormalized annotations."""
+        try:
+            return pred_to_id[pred]
+        except KeyError:
+            _check_normalized(pred)
+            raise
+
+    num_rels = sum(len(a["relationships"]) for a in relationships)
+    pred_ids = np.fromiter(
+        (pred_id(r["predicate"]) for a in relationships for r in a["relationships"]),
+        dtype=np.intp,
+        count=num_rels,
+    )
+
+    # Group relationship positions by predicate with a single stable sort
+    order = np.argsort(pred_ids, kind="stable")
+    bounds = np.searchsorted(pred_ids[order], np.arange(len(pred_to_id) + 1))
+
+    # Randomly keep up to `n_per_pred` relationships per predicate
+    keep_mask = np.zeros(num_rels, dtype=bool)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        positions = order[start:end]
+        if len(positions) > n_per_pred:
+            positions = np.random.choice(positions, n_per_pred, replace=False)
+        keep_mask[positions] = True
+
+    # Unsampled relationships are "UNLABELED"
+    sampled_train = []
+    i = 0
+    for a in relationships:
         updated_rels = []
         for r in a["relationships"]:
-            pred = r["predicate"].lower()
-
-            # Increment idx for a relationship when we encounter it
-            rel_idx[pred] += 1
-
-            # Unsampled relationships are "UNLABELED"
-            if rel_idx[pred] not in pred_idx_samples[pred]:
-                r["predicate"] = "UNLABELED"
-
+            if not keep_mask[i]:
+                r = dict(r, predicate="UNLABELED")
             updated_rels.append(r)
+            i += 1
 
-        a["relationships"] = updated_rels
+        sampled_train.append(dict(a, relationships=updated_rels))
     return sampled_train
 
 
@@ -161,36 +237,45 @@ def get_labels(relationships, predicates, syns_to_preds=None):
         predicates: list of predicates for which we should extract labels
         syns_to_preds: dict mapping synonyms to their corresponding predicates
     Returns:
-        labels: [num_examples, num_predicates] matrix of labels 
+        labels: [num_examples, num_predicates] int8 matrix of labels
             -1 is UNLABELED
             0 is Negative
             +1 is Positive
     """
 
     predicates = sorted(predicates)  # important: sorted so labels correspond
+    pred_to_idx = {pred: i for i, pred in enumerate(predicates)}
+
+    def column(pred):
+        """Column index of `pred` in the label matrix; -1 for UNLABELED."""
+        if pred == "UNLABELED":
+            return -1
+
+        if pred not in pred_to_idx:
+            _check_normalized(pred)
+            if not syns_to_preds:
+                raise ValueError(f"{pred} not found.")
+            pred = syns_to_preds[pred]
+        return pred_to_idx[pred]
+
+    num_rels = sum(len(a["relationships"]) for a in relationships)
+    pred_idxs = np.fromiter(
+        (
+            column(r["predicate"])
+            for a in tqdm(relationships)
+            for r in a["relationships"]
+        ),
+        dtype=np.intp,
+        count=num_rels,
+    )
 
-    labels = []  # -1 > unlabeled, 0 -> negative, +1 > positive
-
-    for a in tqdm(relationships):
-        for r in a["relationships"]:
-            pred = r["predicate"]
-
-            # create labels
-            if pred == "UNLABELED":
-                label = np.ones(len(predicates)) * -1
-            else:
-                pred = pred.lower()
-                if pred not in predicates:
-                    if not syns_to_preds:
-                        raise ValueError(f"{pred} not found.")
-                    pred = syns_to_preds[pred]
-
-                pidx = predicates.index(pred)
-                label = np.zeros(len(predicates))
-                label[pidx] = 1
-            labels.append(label)
+    # -1 > unlabeled, 0 -> negative, +1 > positive
+    labeled = pred_idxs >= 0
+    labels = np.zeros((len(pred_idxs), len(predicates)), dtype=np.int8)
+    labels[np.flatnonzero(labeled), pred_idxs[labeled]] = 1
+    labels[~labeled] = -1
 
-    return np.array(labels)
+    return labels
 
 
 def extract_obj_categories(annotations, predicates, object_synonyms):
@@ -216,20 +301,17 @@ def extract_obj_categories(annotations, predicates, object_synonyms):
                 obj_entities[obj_name] += 1
                 sub_entities[sub_name] += 1
 
-    all_entities = list(obj_entities.keys()) + list(sub_entities.keys())
+    all_entities = set().union(obj_entities, sub_entities)
+
+    # Filter objects based on synonyms of original `object_list`. A synonym may
+    # belong to several objects, so map each one to all of them.
+    syn_to_objs = defaultdict(set)
+    for obj, obj_syns in object_synonyms.items():
+        for syn in obj_syns:
+            syn_to_objs[syn].add(obj)
 
-    # Filter objects based on synonyms of original `object_list`
     obj_categories = sorted(
-        list(
-            set(
-                [
-                    obj
-                    for obj, obj_syns in object_synonyms.items()
-                    for item in all_entities
-                    if item in obj_syns
-                ]
-            )
-        )
+        {obj for item in all_entities for obj in syn_to_objs.get(item, ())}
     )
 
     return obj_categories